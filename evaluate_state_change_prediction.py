@@ -79,6 +79,7 @@ tbatch_timespan = timespan / 500
 # INITIALIZE MODEL PARAMETERS
 model = JODIE(args, num_features, num_users, num_items).cuda()
 weight = jittor.Tensor([1,true_labels_ratio]).cuda()
+y_true_tensor = jittor.array(y_true, dtype=jittor.int64).cuda()
 crossEntropyLoss = nn.CrossEntropyLoss(weight=weight)
 MSELoss = nn.MSELoss()
 
@@ -125,9 +126,8 @@ tbatch_start_time = None
 loss = 0
 # FORWARD PASS
 print("*** Making state change predictions by forward pass (no t-batching) ***")
-with trange(train_end_idx, test_end_idx) as progress_bar:
+with trange(train_end_idx, test_end_idx, desc='Interactions for validation and testing', mininterval=1.0) as progress_bar:
     for j in progress_bar:
-        progress_bar.set_description('%dth interaction for validation and testing' % j)
 
         # LOAD INTERACTION J
         userid = user_sequence_id[j]
@@ -176,7 +176,7 @@ with trange(train_end_idx, test_end_idx) as progress_bar:
 
         # CALCULATE STATE CHANGE LOSS
         if args.state_change:
-            loss += calculate_state_prediction_loss(model, [j], user_embeddings_timeseries, y_true, crossEntropyLoss) 
+            loss += calculate_state_prediction_loss(model, [j], user_embeddings_timeseries, y_true_tensor, crossEntropyLoss) 
 
         # UPDATE THE MODEL IN REAL-TIME USING ERRORS MADE IN THE PAST PREDICTION
         if timestamp - tbatch_start_time > tbatch_timespan:
@@ -9,9 +9,9 @@ Paper: Predicting Dynamic Embedding Trajectory in Temporal Interaction Networks.
 '''
 
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from library_data import *
-import library_models as lib
 from library_models import *
 
 # INITIALIZE PARAMETERS
@@ -23,6 +23,7 @@ parser.add_argument('--epochs', default=50, type=int, help='Number of epochs to
 parser.add_argument('--embedding_dim', default=128, type=int, help='Number of dimensions of the dynamic embedding')
 parser.add_argument('--train_proportion', default=0.8, type=float, help='Fraction of interactions (from the beginning) that are used for training.The next 10% are used for validation and the next 10% for testing')
 parser.add_argument('--state_change', default=True, type=bool, help='True if training with state change of users along with interaction prediction. False otherwise. By default, set to True.')
+parser.add_argument('--amp', default=0, type=int, help='1 to train with automatic mixed precision (float16 activations, float32 parameters), 0 to train in float32')
 
 args = parser.parse_args()
 
@@ -55,9 +56,8 @@ tbatch_timespan = timespan / 500
 # INITIALIZE MODEL AND PARAMETERS
 model = JODIE(args, num_features, num_users, num_items).cuda()
 weight = jittor.Var([1,true_labels_ratio]).cuda()
+y_true_tensor = jittor.array(y_true, dtype=jittor.int64).cuda() # copied to the GPU once, the state change loss indexes into it
 
-
-crossEntropyLoss = nn.CrossEntropyLoss(weight=weight)
 MSELoss = nn.MSELoss()
 
 # INITIALIZE EMBEDDING
@@ -66,16 +66,17 @@ initial_item_embedding = nn.Parameter(jittor.normalize(jittor.rand(args.embeddin
 model.initial_user_embedding = initial_user_embedding
 model.initial_item_embedding = initial_item_embedding
 
-user_embeddings = initial_user_embedding.repeat(num_users, 1) # initialize all users to the same embedding 
-item_embeddings = initial_item_embedding.repeat(num_items, 1) # initialize all items to the same embedding
-
-item_embedding_static = jittor.init.eye(num_items).cuda() # one-hot vectors for static embeddings
-user_embedding_static = jittor.init.eye(num_users).cuda() # one-hot vectors for static embeddings 
-
 # INITIALIZE MODEL
 learning_rate = 1e-3
+# the dynamic user and item embeddings are not parameters, they are rebuilt from the two learned initial embeddings every epoch,
+# so Adam only updates the model weights and the initial embeddings
 optimizer = optim.Adam(model.parameters(), lr=learning_rate, weight_decay=1e-5)
 
+# MIXED PRECISION IS TURNED ON ONLY AFTER THE PARAMETERS ARE CREATED: UNDER THE FLAG NEW ARRAYS ARE FLOAT16, SO THE WEIGHTS WOULD BE TOO
+if args.amp:
+    jittor.flags.auto_mixed_precision_level = 5 # run the matmuls and element-wise ops in float16, reductions stay in float32
+    assert all(param.dtype == jittor.float32 for param in model.parameters()), 'parameters must stay float32 under mixed precision'
+
 # RUN THE JODIE MODEL
 '''
 THE MODEL IS TRAINED FOR SEVERAL EPOCHS. IN EACH EPOCH, JODIES USES THE TRAINING SET OF INTERACTIONS TO UPDATE ITS PARAMETERS.
@@ -83,7 +84,9 @@ THE MODEL IS TRAINED FOR SEVERAL EPOCHS. IN EACH EPOCH, JODIES USES THE TRAINING
 print("*** Training the JODIE model for %d epochs ***" % args.epochs)
 
 # variables to help using tbatch cache between epochs
+# the T-batches of a timespan are stored back to back in one array per field: T-batch i is [offsets[i]:offsets[i+1]]
 is_first_epoch = True
+cached_tbatches_offsets = {}
 cached_tbatches_user = {}
 cached_tbatches_item = {}
 cached_tbatches_interactionids = {}
@@ -92,154 +95,109 @@ cached_tbatches_user_timediffs = {}
 cached_tbatches_item_timediffs = {}
 cached_tbatches_previous_item = {}
 
+# the timespans only depend on the timestamps, so they are the same in every epoch
+timespans = compute_timespans(timestamp_sequence, tbatch_timespan, train_end_idx)
+
+# the T-batches only depend on the training interactions and the timespan, so they are saved to disk and reused by later runs
+tbatches_filename = get_tbatches_filename(args, user_sequence_id, item_sequence_id, timestamp_sequence, tbatch_timespan, train_end_idx)
+tbatches_saved = os.path.exists(tbatches_filename)
+tbatches = load_tbatches(tbatches_filename) if tbatches_saved else {}
+
+# the missing T-batches are created on the CPU by a background thread, ahead of the first epoch that consumes them
+tbatch_builder = ThreadPoolExecutor(max_workers=1)
+created_tbatches = {timestamp: tbatch_builder.submit(create_tbatches, span_start_idx, span_end_idx, user_sequence_id, item_sequence_id, num_users, num_items)
+                    for timestamp, span_start_idx, span_end_idx in timespans if timestamp not in tbatches}
+
+# INITIALIZE EMBEDDING TRAJECTORY STORAGE 
+# every epoch writes the same rows (the interactions of the cached T-batches), so the storage is allocated once and not cleared between epochs
+user_embeddings_timeseries = jittor.zeros((num_interactions, args.embedding_dim)).cuda()
+item_embeddings_timeseries = jittor.zeros((num_interactions, args.embedding_dim)).cuda()
 
 for ep in tqdm(range(args.epochs), desc='Epochs'):
     epoch_start_time = time.time()
-    # INITIALIZE EMBEDDING TRAJECTORY STORAGE 
-    user_embeddings_timeseries = jittor.zeros((num_interactions, args.embedding_dim)).cuda()
-    item_embeddings_timeseries = jittor.zeros((num_interactions, args.embedding_dim)).cuda()
-
-    optimizer.zero_grad()
-    
-    reinitialize_tbatches()
-    
-    total_loss, loss, total_interaction_count = 0, 0, 0
+    # broadcast the learned initial embeddings instead of repeating them, the gradient still reaches them through the first T-batches
+    user_embeddings = initial_user_embedding.unsqueeze(0).broadcast([num_users, args.embedding_dim]) # initialize all users to the same embedding 
+    item_embeddings = initial_item_embedding.unsqueeze(0).broadcast([num_items, args.embedding_dim]) # initialize all items to the same embedding
 
-    tbatch_start_time = None
-    tbatch_to_insert = -1
-    tbatch_full = False
+    total_loss, total_interaction_count = 0, 0
 
     # TRAIN TILL THE END OF TRAINING INTERACTION IDX
-    for j in tqdm(range(train_end_idx), desc='Interactions'):
+    for timestamp, span_start_idx, span_end_idx in tqdm(timespans, desc='Timespans', mininterval=1.0):
         if is_first_epoch:
-            # READ INTERACTION J
-            userid = user_sequence_id[j]
-            itemid = item_sequence_id[j]
-            feature = feature_sequence[j]
-            user_timediff = user_timediffs_sequence[j]
-            item_timediff = item_timediffs_sequence[j]
-
-            # CREATE T-BATCHES: ADD INTERACTION J TO THE CORRECT T-BATCH
-            tbatch_to_insert = max(lib.tbatchid_user[userid], lib.tbatchid_item[itemid]) + 1 #确保tbatch_to_insert是一个新的tbatch，避免冲突
-            lib.tbatchid_user[userid] = tbatch_to_insert
-            lib.tbatchid_item[itemid] = tbatch_to_insert
-
-            lib.current_tbatches_user[tbatch_to_insert].append(userid)
-            lib.current_tbatches_item[tbatch_to_insert].append(itemid)
-            lib.current_tbatches_feature[tbatch_to_insert].append(feature)
-            lib.current_tbatches_interactionids[tbatch_to_insert].append(j)
-            lib.current_tbatches_user_timediffs[tbatch_to_insert].append(user_timediff)
-            lib.current_tbatches_item_timediffs[tbatch_to_insert].append(item_timediff)
-            lib.current_tbatches_previous_item[tbatch_to_insert].append(user_previous_itemid_sequence[j])
-
-        timestamp = timestamp_sequence[j]
-        if tbatch_start_time is None:
-            tbatch_start_time = timestamp
+            # GET THE T-BATCHES OF ALL INTERACTIONS IN THE TIMESPAN AND COPY EACH FIELD TO THE GPU IN ONE GO
+            if timestamp not in tbatches:
+                tbatches[timestamp] = created_tbatches.pop(timestamp).result()
+            interactionids, tbatch_offsets = tbatches[timestamp]
+            cached_tbatches_offsets[timestamp] = tbatch_offsets.tolist()
+            cached_tbatches_user[timestamp] = jittor.array(user_sequence_id[interactionids]).cuda()
+            cached_tbatches_item[timestamp] = jittor.array(item_sequence_id[interactionids]).cuda()
+            cached_tbatches_interactionids[timestamp] = jittor.array(interactionids).cuda()
+            cached_tbatches_feature[timestamp] = jittor.array(feature_sequence[interactionids]).cuda()
+            cached_tbatches_user_timediffs[timestamp] = jittor.array(user_timediffs_sequence[interactionids, None]).cuda()
+            cached_tbatches_item_timediffs[timestamp] = jittor.array(item_timediffs_sequence[interactionids, None]).cuda()
+            cached_tbatches_previous_item[timestamp] = jittor.array(user_previous_itemid_sequence[interactionids]).cuda()
+
+        # from the second epoch on, the same T-batches are replayed with the same shapes, so Jittor reuses the kernels it compiled in the first epoch
+        tbatch_offsets = cached_tbatches_offsets[timestamp]
+        current_tbatches_user = cached_tbatches_user[timestamp]
+        current_tbatches_item = cached_tbatches_item[timestamp]
+        current_tbatches_interactionids = cached_tbatches_interactionids[timestamp]
+        current_tbatches_feature = cached_tbatches_feature[timestamp]
+        current_tbatches_user_timediffs = cached_tbatches_user_timediffs[timestamp]
+        current_tbatches_item_timediffs = cached_tbatches_item_timediffs[timestamp]
+        current_tbatches_previous_item = cached_tbatches_previous_item[timestamp]
+
+        # T-BATCHES DEPEND ON EACH OTHER ONLY THROUGH THE DYNAMIC EMBEDDINGS, SO THE TIMEDIFF AND FEATURE TERMS OF THE WHOLE TIMESPAN ARE COMPUTED IN ONE PASS
+        projection_scale, rnn_static_input = model.precompute_static_inputs(current_tbatches_user_timediffs, current_tbatches_item_timediffs, current_tbatches_feature)
 
         # AFTER ALL INTERACTIONS IN THE TIMESPAN ARE CONVERTED TO T-BATCHES, FORWARD PASS TO CREATE EMBEDDING TRAJECTORIES AND CALCULATE PREDICTION LOSS
-        if timestamp - tbatch_start_time > tbatch_timespan:
-            tbatch_start_time = timestamp # RESET START TIME FOR THE NEXT TBATCHES
-
-            # ITERATE OVER ALL T-BATCHES
-            if not is_first_epoch:
-                lib.current_tbatches_user = cached_tbatches_user[timestamp]
-                lib.current_tbatches_item = cached_tbatches_item[timestamp]
-                lib.current_tbatches_interactionids = cached_tbatches_interactionids[timestamp]
-                lib.current_tbatches_feature = cached_tbatches_feature[timestamp]
-                lib.current_tbatches_user_timediffs = cached_tbatches_user_timediffs[timestamp]
-                lib.current_tbatches_item_timediffs = cached_tbatches_item_timediffs[timestamp]
-                lib.current_tbatches_previous_item = cached_tbatches_previous_item[timestamp]
-
-            # for i in tqdm(range(len(lib.current_tbatches_user)), desc='T-batches'):
-            for i in range(len(lib.current_tbatches_user)):    
-                total_interaction_count += len(lib.current_tbatches_interactionids[i])
-
-                # LOAD THE CURRENT TBATCH
-                if is_first_epoch:
-                    lib.current_tbatches_user[i] = jittor.array(lib.current_tbatches_user[i], dtype=jittor.int64).cuda()
-                    lib.current_tbatches_item[i] = jittor.array(lib.current_tbatches_item[i], dtype=jittor.int64).cuda()
-                    lib.current_tbatches_interactionids[i] = jittor.array(lib.current_tbatches_interactionids[i], dtype=jittor.int64).cuda()
-                    lib.current_tbatches_feature[i] = jittor.Var(lib.current_tbatches_feature[i]).cuda()
-
-                    lib.current_tbatches_user_timediffs[i] = jittor.Var(lib.current_tbatches_user_timediffs[i]).cuda()
-                    lib.current_tbatches_item_timediffs[i] = jittor.Var(lib.current_tbatches_item_timediffs[i]).cuda()
-                    lib.current_tbatches_previous_item[i] = jittor.array(lib.current_tbatches_previous_item[i], dtype=jittor.int64).cuda()
-
-                tbatch_userids = lib.current_tbatches_user[i] # Recall "lib.current_tbatches_user[i]" has unique elements
-                tbatch_itemids = lib.current_tbatches_item[i] # Recall "lib.current_tbatches_item[i]" has unique elements
-                tbatch_interactionids = lib.current_tbatches_interactionids[i]
-                feature_tensor = lib.current_tbatches_feature[i] # Recall "lib.current_tbatches_feature[i]" is list of list, so "feature_tensor" is a 2-d tensor
-                user_timediffs_tensor = lib.current_tbatches_user_timediffs[i].unsqueeze(1)
-                item_timediffs_tensor = lib.current_tbatches_item_timediffs[i].unsqueeze(1)
-                tbatch_itemids_previous = lib.current_tbatches_previous_item[i]
-                item_embedding_previous = item_embeddings[tbatch_itemids_previous,:]
-
-                # PROJECT USER EMBEDDING TO CURRENT TIME
-                user_embedding_input = user_embeddings[tbatch_userids,:]
-                user_projected_embedding = model.forward(user_embedding_input, item_embedding_previous, timediffs=user_timediffs_tensor, features=feature_tensor, select='project')
-                user_item_embedding = jittor.cat([user_projected_embedding, item_embedding_previous, item_embedding_static[tbatch_itemids_previous,:], user_embedding_static[tbatch_userids,:]], dim=1)
-
-                # PREDICT NEXT ITEM EMBEDDING                            
-                predicted_item_embedding = model.predict_item_embedding(user_item_embedding)
-
-                # CALCULATE PREDICTION LOSS
-                item_embedding_input = item_embeddings[tbatch_itemids,:]
-                loss += MSELoss(predicted_item_embedding, jittor.cat([item_embedding_input, item_embedding_static[tbatch_itemids,:]], dim=1).detach())
-
-                # UPDATE DYNAMIC EMBEDDINGS AFTER INTERACTION
-                user_embedding_output = model.forward(user_embedding_input, item_embedding_input, timediffs=user_timediffs_tensor, features=feature_tensor, select='user_update')
-                item_embedding_output = model.forward(user_embedding_input, item_embedding_input, timediffs=item_timediffs_tensor, features=feature_tensor, select='item_update')
-
-                item_embeddings[tbatch_itemids,:] = item_embedding_output
-                user_embeddings[tbatch_userids,:] = user_embedding_output  
-
-                user_embeddings_timeseries[tbatch_interactionids,:] = user_embedding_output
-                item_embeddings_timeseries[tbatch_interactionids,:] = item_embedding_output
-
-                # CALCULATE LOSS TO MAINTAIN TEMPORAL SMOOTHNESS
-                loss += MSELoss(item_embedding_output, item_embedding_input.detach())
-                loss += MSELoss(user_embedding_output, user_embedding_input.detach())
-
-                # CALCULATE STATE CHANGE LOSS
-                if args.state_change:
-                    loss += calculate_state_prediction_loss(model, tbatch_interactionids, user_embeddings_timeseries, y_true, crossEntropyLoss) 
-
-            # BACKPROPAGATE ERROR AFTER END OF T-BATCH
-            total_loss += loss.item()
-            optimizer.step(loss)
-
-            # RESET LOSS FOR NEXT T-BATCH
-            loss = 0
-            item_embeddings.stop_grad() # Detachment is needed to prevent double propagation of gradient
-            user_embeddings.stop_grad()
-            item_embeddings_timeseries.stop_grad() 
-            user_embeddings_timeseries.stop_grad()
-            
-            # REINITIALIZE
-            if is_first_epoch:
-                cached_tbatches_user[timestamp] = lib.current_tbatches_user
-                cached_tbatches_item[timestamp] = lib.current_tbatches_item
-                cached_tbatches_interactionids[timestamp] = lib.current_tbatches_interactionids
-                cached_tbatches_feature[timestamp] = lib.current_tbatches_feature
-                cached_tbatches_user_timediffs[timestamp] = lib.current_tbatches_user_timediffs
-                cached_tbatches_item_timediffs[timestamp] = lib.current_tbatches_item_timediffs
-                cached_tbatches_previous_item[timestamp] = lib.current_tbatches_previous_item
-                
-                reinitialize_tbatches()
-                tbatch_to_insert = -1
-
+        # the losses are collected and summed once at the end of the timespan, instead of chaining one addition per T-batch
+        losses = []
+        # ITERATE OVER ALL T-BATCHES
+        for i in range(len(tbatch_offsets) - 1):
+            tbatch_start, tbatch_end = tbatch_offsets[i], tbatch_offsets[i+1]
+            total_interaction_count += tbatch_end - tbatch_start
+
+            # LOAD THE CURRENT TBATCH
+            tbatch_userids = current_tbatches_user[tbatch_start:tbatch_end] # Recall the users of a T-batch are unique
+            tbatch_itemids = current_tbatches_item[tbatch_start:tbatch_end] # Recall the items of a T-batch are unique
+            tbatch_interactionids = current_tbatches_interactionids[tbatch_start:tbatch_end]
+            tbatch_itemids_previous = current_tbatches_previous_item[tbatch_start:tbatch_end]
+
+            # PREDICT THE NEXT ITEMS AND UPDATE THE DYNAMIC EMBEDDINGS AFTER INTERACTION
+            losses.append(process_tbatch(model, tbatch_userids, tbatch_itemids, tbatch_itemids_previous, tbatch_interactionids,
+                                         projection_scale[tbatch_start:tbatch_end], rnn_static_input[:, tbatch_start:tbatch_end],
+                                         user_embeddings, item_embeddings, user_embeddings_timeseries, item_embeddings_timeseries, MSELoss))
+
+        # CALCULATE STATE CHANGE LOSS OF ALL T-BATCHES OF THE TIMESPAN AT ONCE
+        if args.state_change:
+            losses.append(calculate_timespan_state_prediction_loss(model, current_tbatches_interactionids, tbatch_offsets, user_embeddings_timeseries, y_true_tensor, weight))
+
+        # BACKPROPAGATE ERROR AFTER END OF T-BATCH
+        loss = jittor.concat([tbatch_loss.flatten() for tbatch_loss in losses]).sum()
+        total_loss += loss.item()
+        optimizer.step(loss)
+
+        # RESET FOR NEXT T-BATCH
+        item_embeddings.stop_grad() # Detachment is needed to prevent double propagation of gradient
+        user_embeddings.stop_grad()
+        item_embeddings_timeseries.stop_grad() 
+        user_embeddings_timeseries.stop_grad()
+
+    if is_first_epoch:
+        tbatch_builder.shutdown()
+        if not tbatches_saved:
+            save_tbatches(tbatches, tbatches_filename)
     is_first_epoch = False # as first epoch ends here
     print("Last epoch took {} minutes".format((time.time()-epoch_start_time)/60))
     # END OF ONE EPOCH 
     print("\n\nTotal loss in this epoch = %f" % (total_loss))
-    item_embeddings_dystat = jittor.cat([item_embeddings, item_embedding_static], dim=1)
-    user_embeddings_dystat = jittor.cat([user_embeddings, user_embedding_static], dim=1)
+    # the static embeddings are one-hot vectors; they are only built here to save the embeddings in the format the evaluation scripts read
+    item_embeddings_dystat = jittor.cat([item_embeddings, jittor.init.eye(num_items).cuda()], dim=1)
+    user_embeddings_dystat = jittor.cat([user_embeddings, jittor.init.eye(num_users).cuda()], dim=1)
     # SAVE CURRENT MODEL TO DISK TO BE USED IN EVALUATION.
     save_model(model, optimizer, args, ep, user_embeddings_dystat, item_embeddings_dystat, train_end_idx, user_embeddings_timeseries, item_embeddings_timeseries)
 
-    user_embeddings = initial_user_embedding.repeat(num_users, 1)
-    item_embeddings = initial_item_embedding.repeat(num_items, 1)
-
 # END OF ALL EPOCHS. SAVE FINAL MODEL DISK TO BE USED IN EVALUATION.
 print("\n\n*** Training complete. Saving final model. ***\n\n")
 save_model(model, optimizer, args, ep, user_embeddings_dystat, item_embeddings_dystat, train_end_idx, user_embeddings_timeseries, item_embeddings_timeseries)
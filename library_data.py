@@ -103,6 +103,14 @@ def load_network(args, time_scaling=True):
         user_timedifference_sequence = scale(np.array(user_timedifference_sequence) + 1)
         item_timedifference_sequence = scale(np.array(item_timedifference_sequence) + 1)
 
+    # contiguous arrays of fixed dtypes, so that T-batches are built by slicing instead of copying python lists
+    user_sequence_id = np.array(user_sequence_id, dtype=np.int64)
+    item_sequence_id = np.array(item_sequence_id, dtype=np.int64)
+    user_previous_itemid_sequence = np.array(user_previous_itemid_sequence, dtype=np.int64)
+    user_timedifference_sequence = np.array(user_timedifference_sequence, dtype=np.float32)
+    item_timedifference_sequence = np.array(item_timedifference_sequence, dtype=np.float32)
+    feature_sequence = np.array(feature_sequence, dtype=np.float32)
+
     print("*** Network loading completed ***\n\n")
     return [user2id, user_sequence_id, user_timedifference_sequence, user_previous_itemid_sequence, \
         item2id, item_sequence_id, item_timedifference_sequence, \
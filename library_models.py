@@ -10,10 +10,12 @@ import jittor.nn as F
 # from jittor.autograd import Variable
 from jittor import optim
 import numpy as np
+from numba import njit
 import math, random
 import sys
 from collections import defaultdict
 import os
+import hashlib
 # import gpustat
 from itertools import chain
 from tqdm import tqdm, tqdm_notebook, tnrange
@@ -86,6 +88,33 @@ class JODIE(nn.Module):
             #user_projected_embedding = jittor.cat([input3, item_embeddings], dim=1)
             return user_projected_embedding
 
+    def precompute_static_inputs(self, user_timediffs, item_timediffs, features):
+        '''
+        Computes the parts of forward_fused() that do not depend on the dynamic embeddings, for all interactions of a timespan at once.
+        Returns the scale of the user projection and the timediff/feature part of both RNN cells (stacked as user, item), one row per interaction.
+        '''
+        projection_scale = 1 + self.embedding_layer(user_timediffs)
+
+        rnn_static_input = jittor.stack([jittor.cat([user_timediffs, features], dim=1), jittor.cat([item_timediffs, features], dim=1)])
+        weight_ih = jittor.stack([self.user_rnn.weight_ih, self.item_rnn.weight_ih])[:, :, self.embedding_dim:].permute(0, 2, 1)
+        bias = jittor.stack([self.user_rnn.bias_ih + self.user_rnn.bias_hh, self.item_rnn.bias_ih + self.item_rnn.bias_hh]).unsqueeze(1)
+        return projection_scale, nn.bmm(rnn_static_input, weight_ih) + bias
+
+    def forward_fused(self, user_embeddings, item_embeddings, projection_scale, rnn_static_input):
+        '''
+        Does the 'project', 'user_update' and 'item_update' passes of forward() together and returns their three outputs.
+        projection_scale and rnn_static_input are the rows of this T-batch in the output of precompute_static_inputs().
+        The user and item RNN cells have the same shapes, so both updates run as one batched matmul over their stacked weights.
+        '''
+        user_projected_embedding = user_embeddings * projection_scale
+
+        rnn_dynamic_input = jittor.stack([item_embeddings, user_embeddings])
+        rnn_hidden = jittor.stack([user_embeddings, item_embeddings])
+        weight_ih = jittor.stack([self.user_rnn.weight_ih, self.item_rnn.weight_ih])[:, :, :self.embedding_dim].permute(0, 2, 1)
+        weight_hh = jittor.stack([self.user_rnn.weight_hh, self.item_rnn.weight_hh]).permute(0, 2, 1)
+        embedding_output = jittor.normalize(jittor.tanh(rnn_static_input + nn.bmm(rnn_dynamic_input, weight_ih) + nn.bmm(rnn_hidden, weight_hh)), dim=2)
+        return user_projected_embedding, embedding_output[0], embedding_output[1]
+
     def context_convert(self, embeddings, timediffs, features):
         new_embeddings = embeddings * (1 + self.embedding_layer(timediffs))
         return new_embeddings
@@ -99,6 +128,17 @@ class JODIE(nn.Module):
         X_out = self.prediction_layer(user_embeddings)
         return X_out
 
+    def predict_item_embedding_from_ids(self, user_item_embedding, itemids_previous, userids):
+        '''
+        Same as predict_item_embedding() on [user_item_embedding, one-hot of itemids_previous, one-hot of userids], without building the one-hot vectors:
+        multiplying a one-hot vector by the weight of the prediction layer only picks one of its columns.
+        '''
+        dynamic_size = self.embedding_dim * 2
+        weight = self.prediction_layer.weight
+        static_columns = weight[:, dynamic_size + itemids_previous] + weight[:, dynamic_size + self.item_static_embedding_size + userids]
+        X_out = nn.matmul_transpose(user_item_embedding, weight[:, :dynamic_size]) + static_columns.transpose(1, 0) + self.prediction_layer.bias
+        return X_out
+
 
 # INITIALIZE T-BATCH VARIABLES初始化T-BATCH全局变量
 def reinitialize_tbatches():
@@ -129,17 +169,129 @@ def reinitialize_tbatches():
     total_reinitialization_count +=1
 
 
+# SPLIT THE TRAINING INTERACTIONS INTO TIMESPANS
+def compute_timespans(timestamp_sequence, tbatch_timespan, end_idx):
+    '''
+    Returns one (timestamp, start_idx, end_idx) tuple per timespan, in temporal order.
+    A timespan is closed by the first interaction that happens more than tbatch_timespan after the interaction that closed the previous one.
+    Interactions after the last closed timespan are not used for training.
+    '''
+    timestamps = timestamp_sequence[:end_idx]
+    timespans = []
+    span_start_idx = 0
+    tbatch_start_time = timestamps[0]
+    while True:
+        span_last_idx = np.searchsorted(timestamps, tbatch_start_time + tbatch_timespan, side='right')
+        if span_last_idx >= end_idx:
+            break
+        tbatch_start_time = timestamps[span_last_idx]
+        timespans.append((tbatch_start_time, span_start_idx, span_last_idx + 1))
+        span_start_idx = span_last_idx + 1
+    return timespans
+
+
+# ASSIGN EVERY INTERACTION TO A T-BATCH
+# the recurrence is sequential, so it is compiled instead of vectorized; nogil lets it run in a background thread
+@njit(cache=True, nogil=True)
+def compute_tbatch_ids(user_ids, item_ids, num_users, num_items):
+    # an interaction goes to the T-batch right after the latest T-batch of its user and of its item
+    user_last = np.full(num_users, -1, dtype=np.int64)
+    item_last = np.full(num_items, -1, dtype=np.int64)
+    tbatch_ids = np.empty(len(user_ids), dtype=np.int64)
+    for j in range(len(user_ids)):
+        tbatch_to_insert = max(user_last[user_ids[j]], item_last[item_ids[j]]) + 1
+        user_last[user_ids[j]] = tbatch_to_insert
+        item_last[item_ids[j]] = tbatch_to_insert
+        tbatch_ids[j] = tbatch_to_insert
+    return tbatch_ids
+
+
+# CREATE THE T-BATCHES OF THE INTERACTIONS IN [start_idx, end_idx)
+def create_tbatches(start_idx, end_idx, user_sequence_id, item_sequence_id, num_users, num_items):
+    '''
+    Returns the interaction ids grouped by T-batch and the offsets of each T-batch in that array:
+    the interactions of T-batch i are tbatch_interactionids[offsets[i]:offsets[i+1]], in temporal order.
+    A user or an item appears at most once per T-batch, so its embedding update is a plain scatter; repeated interactions of a user or item
+    land in later T-batches and see the embedding written by the earlier ones.
+    '''
+    tbatch_ids = compute_tbatch_ids(user_sequence_id[start_idx:end_idx], item_sequence_id[start_idx:end_idx], num_users, num_items)
+    order = np.argsort(tbatch_ids, kind='stable')
+    tbatch_offsets = np.concatenate([[0], np.cumsum(np.bincount(tbatch_ids))])
+    return order + start_idx, tbatch_offsets
+
+
 # CALCULATE LOSS FOR THE PREDICTED USER STATE 
+# "y_true" is the int64 array of all state labels, already on the GPU
 def calculate_state_prediction_loss(model, tbatch_interactionids, user_embeddings_time_series, y_true, loss_function):
     # PREDCIT THE LABEL FROM THE USER DYNAMIC EMBEDDINGS
     prob = model.predict_label(user_embeddings_time_series[tbatch_interactionids,:])
-    y = jittor.Var(jittor.array(y_true, dtype=jittor.int64).cuda()[tbatch_interactionids])
+    y = y_true[tbatch_interactionids]
     
     loss = loss_function(prob, y)
 
     return loss
 
 
+# CALCULATE THE STATE PREDICTION LOSS OF ALL T-BATCHES OF A TIMESPAN AT ONCE
+def calculate_timespan_state_prediction_loss(model, interactionids, tbatch_offsets, user_embeddings_time_series, y_true, weight):
+    '''
+    Same as summing calculate_state_prediction_loss() with a cross entropy loss weighted by "weight" over the T-batches of a timespan:
+    each T-batch contributes the weighted mean loss of its interactions, which are interactionids[tbatch_offsets[i]:tbatch_offsets[i+1]].
+    "y_true" is the int64 array of all state labels, already on the GPU.
+    '''
+    # PREDCIT THE LABELS FROM THE USER DYNAMIC EMBEDDINGS OF THE WHOLE TIMESPAN
+    prob = model.predict_label(user_embeddings_time_series[interactionids])
+    y = y_true[interactionids]
+    label_weight = weight[y]
+    weighted_loss = -(nn.log_softmax(prob, dim=1) * nn.one_hot(y, 2).float32()).sum(1) * label_weight
+
+    # SUMS OVER EACH T-BATCH ARE DIFFERENCES OF THE RUNNING SUMS AT THE T-BATCH BOUNDARIES (IN DOUBLE PRECISION TO KEEP SMALL T-BATCHES EXACT)
+    zero = jittor.zeros(1, dtype=jittor.float64)
+    cumulative_loss = jittor.cat([zero, jittor.cumsum(weighted_loss.float64(), dim=0)])
+    cumulative_weight = jittor.cat([zero, jittor.cumsum(label_weight.float64(), dim=0)])
+    starts = jittor.array(tbatch_offsets[:-1])
+    ends = jittor.array(tbatch_offsets[1:])
+    loss = ((cumulative_loss[ends] - cumulative_loss[starts]) / (cumulative_weight[ends] - cumulative_weight[starts])).sum()
+
+    return loss.float32()
+
+
+# PROCESS ONE T-BATCH: PREDICT THE NEXT ITEMS AND UPDATE THE DYNAMIC EMBEDDINGS
+def process_tbatch(model, tbatch_userids, tbatch_itemids, tbatch_itemids_previous, tbatch_interactionids, projection_scale, rnn_static_input,
+                   user_embeddings, item_embeddings, user_embeddings_time_series, item_embeddings_time_series, loss_function):
+    '''
+    projection_scale and rnn_static_input are the rows of the T-batch in the output of model.precompute_static_inputs().
+    The dynamic embeddings and their time series are updated in place.
+    Returns the prediction loss plus the temporal smoothness loss of the T-batch.
+    '''
+    item_embedding_previous = item_embeddings[tbatch_itemids_previous]
+
+    # PROJECT USER EMBEDDING TO CURRENT TIME AND UPDATE DYNAMIC EMBEDDINGS AFTER INTERACTION, IN ONE FUSED PASS
+    user_embedding_input = user_embeddings[tbatch_userids]
+    item_embedding_input = item_embeddings[tbatch_itemids]
+    user_projected_embedding, user_embedding_output, item_embedding_output = model.forward_fused(user_embedding_input, item_embedding_input, projection_scale, rnn_static_input)
+    user_item_embedding = jittor.cat([user_projected_embedding, item_embedding_previous], dim=1)
+
+    # PREDICT NEXT ITEM EMBEDDING
+    predicted_item_embedding = model.predict_item_embedding_from_ids(user_item_embedding, tbatch_itemids_previous, tbatch_userids)
+
+    # CALCULATE PREDICTION LOSS
+    item_embedding_static = nn.one_hot(tbatch_itemids, model.num_items).float32() # one-hot vectors for static embeddings
+    loss = loss_function(predicted_item_embedding, jittor.cat([item_embedding_input, item_embedding_static], dim=1).detach())
+
+    item_embeddings[tbatch_itemids] = item_embedding_output
+    user_embeddings[tbatch_userids] = user_embedding_output
+
+    user_embeddings_time_series[tbatch_interactionids] = user_embedding_output
+    item_embeddings_time_series[tbatch_interactionids] = item_embedding_output
+
+    # CALCULATE LOSS TO MAINTAIN TEMPORAL SMOOTHNESS
+    # the item and user terms average over the same number of elements, so their sum is twice the mean over both stacked together
+    loss += 2 * loss_function(jittor.stack([item_embedding_output, user_embedding_output]), jittor.stack([item_embedding_input, user_embedding_input]).detach())
+
+    return loss
+
+
 # SAVE TRAINED MODEL TO DISK
 def save_model(model, optimizer, args, epoch, user_embeddings, item_embeddings, train_end_idx, user_embeddings_time_series=None, item_embeddings_time_series=None, path=PATH):
     print("*** Saving embeddings and model ***")
@@ -165,6 +317,30 @@ def save_model(model, optimizer, args, epoch, user_embeddings, item_embeddings,
     print("*** Saved embeddings and model to file: %s ***\n\n" % filename)
 
 
+# FILE OF THE T-BATCHES OF THE TRAINING INTERACTIONS
+def get_tbatches_filename(args, user_sequence_id, item_sequence_id, timestamp_sequence, tbatch_timespan, train_end_idx, path=PATH):
+    # the T-batches only depend on these inputs, so the filename is keyed on their hash and changes with the data
+    digest = hashlib.md5()
+    digest.update(user_sequence_id[:train_end_idx].tobytes())
+    digest.update(item_sequence_id[:train_end_idx].tobytes())
+    digest.update(np.asarray(timestamp_sequence[:train_end_idx], dtype=np.float64).tobytes())
+    digest.update(np.float64(tbatch_timespan).tobytes())
+    return os.path.join(path, "data/%s.tbatches.%s.pkl" % (args.network, digest.hexdigest()))
+
+
+# SAVE THE T-BATCHES OF EVERY TIMESPAN TO DISK
+def save_tbatches(tbatches, filename):
+    print("*** Saving T-batches ***")
+    jittor.save(tbatches, filename)
+    print("*** Saved T-batches to file: %s ***\n\n" % filename)
+
+
+# LOAD PREVIOUSLY SAVED T-BATCHES
+def load_tbatches(filename):
+    print("Loading saved T-batches: %s" % filename)
+    return jittor.load(filename)
+
+
 # LOAD PREVIOUSLY TRAINED AND SAVED MODEL
 def load_model(model, optimizer, args, epoch):
     modelname = args.model
@@ -115,12 +115,12 @@ for j in range(num_interactions):
             tbatch_userids = lib.current_tbatches_user[tidx] # "lib.current_tbatches_user[tidx]" has unique elements
             tbatch_itemids = lib.current_tbatches_item[tidx] # "lib.current_tbatches_item[tidx]" has unique elements
             tbatch_timestamps = lib.current_tbatches_timestamp[tidx] # "lib.current_tbatches_item[tidx]" has unique elements
-            tbatch_features = lib.current_tbatches_feature[tidx] # "lib.current_tbatches_feature[tidx]" is list of list, so "feature_tensor" is a 2-d tensor
+            tbatch_features = lib.current_tbatches_feature[tidx] # "lib.current_tbatches_feature[tidx]" is a list of feature arrays
             tbatch_labels = lib.current_tbatches_label[tidx] 
 
             batch = zip(tbatch_userids, tbatch_itemids, tbatch_timestamps, tbatch_labels, tbatch_features)
             for uid, iid, ts, lbl, feature in batch:
-                arr = map(str, [tbatchID, uid, iid, ts, lbl] + feature)
+                arr = map(str, [tbatchID, uid, iid, ts, lbl] + list(feature))
                 fout.write(",".join(arr) + "\n")
 
         reinitialize_tbatches()